@@ -1,4 +1,5 @@
 import json
+from functools import lru_cache
 from pathlib import Path
 
 from common_libs.containers.container import BaseContainer, requires_container
@@ -7,6 +8,12 @@ from common_libs.logging import get_logger
 logger = get_logger(__name__)
 
 
+@lru_cache
+def _load_project_id(service_account_file_path: str) -> str:
+    """Load the project ID from the service account file. The result is cached per file path"""
+    return json.loads(Path(service_account_file_path).read_text())["project_id"]
+
+
 class GCloudSDKContainer(BaseContainer):
     """GCloud SDK container
 
@@ -23,7 +30,7 @@ class GCloudSDKContainer(BaseContainer):
         **kwargs,
     ):
         self.service_account_file_path = Path(service_account_file_path)
-        self.project = json.loads(self.service_account_file_path.read_text())["project_id"]
+        self.project = _load_project_id(str(self.service_account_file_path.resolve()))
         super().__init__(
             "google/cloud-sdk", tag=tag, labels={"project": self.project, "version": "1.0.0"}, timeout=timeout, **kwargs
         )
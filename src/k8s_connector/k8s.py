@@ -3,14 +3,14 @@ from __future__ import annotations
 import json
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, field
-from datetime import UTC, datetime
+from datetime import datetime
 from enum import StrEnum
-from functools import cached_property, lru_cache, partial, wraps
+from functools import cached_property, partial, wraps
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal
 
-import dateparser
 import yaml
 from common_libs.ansi_colors import remove_color_code
 from common_libs.containers.container import requires_container
@@ -18,7 +18,7 @@ from common_libs.containers.utils.log_parser import parse_json_logs, parse_strea
 from common_libs.containers.utils.output_parser import parse_table_output
 from common_libs.lock import Lock
 from common_libs.logging import get_logger
-from common_libs.utils import list_items, wait_until
+from common_libs.utils import list_items
 
 from .gcloud_sdk import GCloudSDKContainer
 
@@ -61,16 +61,21 @@ APP_JSON_LOGGING_FORMATTER: dict[K8sApp, str] = {
     K8sApp.APP1: "[{created}] [{levelname}]{{{request_id}}}[{logger_name}] - {message}"
 }
 
+AGE_PATTERN = re.compile(r"(?:(\d+)y)?(?:(\d+)d)?(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?")
 
-def requires_jq(f):
-    """A decorated function requires jq"""
 
-    @wraps(f)
-    def wrapper(self: K8sConnector, *args, **kwargs):
-        self._install_jq()
-        return f(self, *args, **kwargs)
+def parse_age(age: str) -> int:
+    """Parse pod AGE value of kubectl output and return it in seconds
 
-    return wrapper
+    eg.
+        - "45s" -> 45
+        - "12h34m" -> 45240
+        - "2d" -> 172800
+    """
+    if not age or not (matched := AGE_PATTERN.fullmatch(age)):
+        raise ValueError(f"Unable to parse pod age: {age}")
+    y, d, h, m, s = (int(x or 0) for x in matched.groups())
+    return (((y * 365 + d) * 24 + h) * 60 + m) * 60 + s
 
 
 def restrict_unparsable_options(f):
@@ -99,8 +104,8 @@ class K8sConnector(GCloudSDKContainer):
         >>> k8s.app1.get_logs(follow=True)
     """
 
-    IS_SETUP_DONE = False
-    JQ_INSTALLED = False
+    # IDs of containers where the k8s env setup has been done
+    _setup_done_container_ids: set[str] = set()
 
     def __init__(
         self,
@@ -122,6 +127,7 @@ class K8sConnector(GCloudSDKContainer):
         self.zone = zone
         self.app_label_selector_key = app_label_selector_key
         self._app_context: K8sAppContext | None = None
+        self._app_connectors: dict[K8sApp | str, K8sConnectorWithAppContext] = {}
 
         if run:
             self.run()
@@ -130,15 +136,13 @@ class K8sConnector(GCloudSDKContainer):
         """Start the container and do setup"""
         super().run()
 
-        # Use lock so that the setup is done only once when the container is used in threads
-        with Lock("k8s_connector_setup"):
-            if not self.reused:
-                # Reset the existing env setup flag so that k8s env setup will always be triggered on the new container
-                K8sConnector.IS_SETUP_DONE = False
-
-            if not K8sConnector.IS_SETUP_DONE:
+        # Use lock so that the setup is done only once per container when the container is used in threads.
+        # The lock is per container so that connectors for different containers don't block each other
+        container_id = self.container.id
+        with Lock(f"k8s_connector_setup_{container_id}"):
+            if container_id not in K8sConnector._setup_done_container_ids:
                 self._setup_kubeconfig()
-                K8sConnector.IS_SETUP_DONE = True
+                K8sConnector._setup_done_container_ids.add(container_id)
 
     @property
     def app_context(self) -> K8sAppContext:
@@ -151,18 +155,13 @@ class K8sConnector(GCloudSDKContainer):
     @property
     def env_vars(self) -> dict[str, str]:
         """Return non-confidential env vars set as configmap"""
-        jsonpath = '{.items[?(@.kind == "ConfigMap")].data}'
-        cmd = f"kubectl get configmap {self._app_filtering_options} -o jsonpath='{jsonpath}'"
-        _, output = self.exec_run(cmd, quiet=True)
-        if output:
-            return json.loads(output)
-        else:
-            return {}
+        return self.get_configmap_data(parse=True, quiet=True)
 
-    @lru_cache
     def with_app_context(self, app: K8sApp | str) -> K8sConnectorWithAppContext:
         """Return a k8s connector with the specified app context been set"""
-        return K8sConnectorWithAppContext(self, app)
+        if (connector := self._app_connectors.get(app)) is None:
+            connector = self._app_connectors[app] = K8sConnectorWithAppContext(self, app)
+        return connector
 
     @cached_property
     def app1(self):
@@ -171,34 +170,42 @@ class K8sConnector(GCloudSDKContainer):
 
     @requires_container
     @restrict_unparsable_options
-    def get_namespaces(self, parse: bool = False, **kwargs) -> str | list[dict[str, str]]:
+    def get_namespaces(
+        self, parse: bool | Literal["json"] = False, **kwargs
+    ) -> str | list[dict[str, str]] | dict[str, Any]:
         """Get output of 'kubectl get namespaces' command
 
-        :param parse: Parse the raw output and return as a list of dictionaries
+        :param parse: Parse the raw output and return as a list of dictionaries. If "json" is given, get the output in
+                      JSON format instead and return the parsed object as is
         :param kwargs: Any parameters supported in exec_run()
         """
         cmd = "kubectl get namespaces"
+        if parse == "json":
+            cmd += " -o json"
         _, output = self.exec_run(cmd, **kwargs)
-        if parse:
+        if parse == "json":
+            return json.loads(output)
+        elif parse:
             return parse_table_output(output)
         else:
             return output
 
     @requires_container
     @restrict_unparsable_options
-    def get_pods(self, parse: bool = False, **kwargs) -> str | list[dict[str, str]]:
+    def get_pods(self, parse: bool | Literal["json"] = False, **kwargs) -> str | list[dict[str, str]] | dict[str, Any]:
         """Get output of 'kubectl get pods' command for the current app/namespace, or for all apps/namespaces
 
-        :param parse: Parse the raw output and return as a list of dictionaries
+        :param parse: Parse the raw output and return as a list of dictionaries. If "json" is given, get the output in
+                      JSON format instead and return the parsed object as is
         :param kwargs: Any parameters supported in exec_run()
         """
-        cmd = "kubectl get pods"
-        if self._app_context:
-            cmd += f" {self._app_filtering_options}"
-        else:
-            cmd += " -A"
+        cmd = self._get_pods_cmd
+        if parse == "json":
+            cmd += " -o json"
         _, output = self.exec_run(cmd, **kwargs)
-        if parse:
+        if parse == "json":
+            return json.loads(output)
+        elif parse:
             return parse_table_output(output)
         else:
             return output
@@ -228,14 +235,10 @@ class K8sConnector(GCloudSDKContainer):
         """
         if pod_name:
             cmd = f"kubectl describe pods {pod_name} -n {self.app_context.namespace}"
-            _, output = self.exec_run(cmd, **kwargs)
-            return output
         else:
-            output = ""
-            pods = self.get_pods(parse=True)
-            for name in [pod["NAME"] for pod in pods]:
-                output += self.describe_pods(name, **kwargs)
-            return output
+            cmd = f"kubectl describe pods {self._app_filtering_options}"
+        _, output = self.exec_run(cmd, **kwargs)
+        return output
 
     @requires_container
     def get_logs(
@@ -310,6 +313,9 @@ class K8sConnector(GCloudSDKContainer):
         if previous:
             cmd += " --previous=true"
         if since_time:
+            # dateparser is slow to import. Import it only when it is needed
+            import dateparser
+
             dt = dateparser.parse(since_time, settings={"TIMEZONE": "UTC", "RETURN_AS_TIMEZONE_AWARE": True})
             _since_time = datetime.strftime(dt, "%Y-%m-%dT%H:%M:%S%z")
             cmd += f' --since-time="{_since_time[:-2]}:{_since_time[-2:]}"'
@@ -324,44 +330,50 @@ class K8sConnector(GCloudSDKContainer):
             self.exec_run(cmd, stream=True, output_parser=log_parser, **kwargs)
         else:
             _, output = self.exec_run(cmd, output_parser=log_parser, **kwargs)
-            if remove_color:
+            # Skip scanning the whole output with regex when it doesn't contain any escape sequence
+            if remove_color and "\x1b" in output:
                 output = remove_color_code(output)
             return output
 
     @requires_container
     @restrict_unparsable_options
-    @requires_jq
     def get_configmap_data(self, parse: bool = False, **kwargs) -> str | dict[str, str]:
-        """Get filtered output of 'kubectl get configmap' command
+        """Get data of configmaps from the output of 'kubectl get configmap' command
 
         :param parse: Parse the raw output and return as a dictionary
         :param kwargs: Any parameters supported in exec_run()
         """
-        cmd = (
-            f"kubectl get configmap {self._app_filtering_options} -o json | "
-            f"jq '.items[] | select(.kind == \"ConfigMap\") | .data'"
-        )
+        # Output data of each configmap as a JSON object per line
+        jsonpath = '{range .items[?(@.kind == "ConfigMap")]}{.data}{"\\n"}{end}'
+        cmd = f"kubectl get configmap {self._app_filtering_options} -o jsonpath='{jsonpath}'"
         _, output = self.exec_run(cmd, **kwargs)
         if parse:
-            return json.loads(output)
+            data = {}
+            for line in output.splitlines():
+                if line:
+                    data.update(json.loads(line))
+            return data
         else:
             return output
 
     @requires_container
     @restrict_unparsable_options
-    def get_events(self, parse: bool = False, **kwargs) -> str | list[dict[str, str]]:
+    def get_events(
+        self, parse: bool | Literal["json"] = False, **kwargs
+    ) -> str | list[dict[str, str]] | dict[str, Any]:
         """Get output of 'kubectl get events' command for the current namespace, or all namespaces
 
-        :param parse: Parse the raw output and return as a list of dictionaries
+        :param parse: Parse the raw output and return as a list of dictionaries. If "json" is given, get the output in
+                      JSON format instead and return the parsed object as is
         :param kwargs: Any parameters supported in exec_run()
         """
-        cmd = "kubectl get events --sort-by=.metadata.creationTimestamp"
-        if self._app_context:
-            cmd += f" -n {self.app_context.namespace}"
-        else:
-            cmd += " -A"
+        cmd = self._get_events_cmd
+        if parse == "json":
+            cmd += " -o json"
         _, output = self.exec_run(cmd, **kwargs)
-        if parse:
+        if parse == "json":
+            return json.loads(output)
+        elif parse:
             if "No resources found" in output:
                 return []
             else:
@@ -391,6 +403,28 @@ class K8sConnector(GCloudSDKContainer):
         self.wait_for_deployment_to_start()
         self.wait_for_deployment_to_complete()
 
+    @requires_container
+    def wait_for_deployments(self, *apps: K8sApp | str):
+        """Wait for deployments of multiple apps concurrently
+
+        NOTE: The first failure is raised without waiting for the rest of the deployments. Waits that are already in
+              progress can not be cancelled, and they will continue running in the background
+
+        :param apps: Apps to wait for. Each app must be defined in K8sApp
+        """
+        if not apps:
+            raise ValueError("At least one app is required")
+
+        # K8sApp is a StrEnum. This also dedupes the same app given as a str and as a K8sApp
+        connectors = {app: self.with_app_context(app) for app in apps}
+        executor = ThreadPoolExecutor(max_workers=len(connectors))
+        try:
+            futures = [executor.submit(connector.wait_for_deployment) for connector in connectors.values()]
+            for future in as_completed(futures):
+                future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
     @requires_container
     def wait_for_deployment_to_start(self, timeout_sec: int = 300, thresholds_to_skip: int = 180):
         """Wait for deployment to start (=at least one container's status shows PodInitializing or Init:0/1)
@@ -400,60 +434,28 @@ class K8sConnector(GCloudSDKContainer):
                                    mean deployment already happened recently. For now the threshold is
                                    180 seconds from the current time
         """
-
-        def format_age(age_str: str) -> str:
-            """Format pod AGE value to be something dateparser can parse
-
-            eg.
-                - "12h34m" -> "12h 34m"
-                - "2d" -> "2 days"
-            """
-            pattern_d = r"(\d+)d"
-            pattern_h_m = r"(\d+)h(\d+)m"
-            if re.match(pattern_h_m, age_str):
-                age = re.sub(pattern_h_m, r"\1h \2m", age_str)
-            elif matched := re.match(pattern_d, age_str):
-                age = f"{matched.group(1)} days"
-            else:
-                age = age_str
-            return age
-
-        def did_all_pods_start_within(seconds: int) -> bool:
-            """Check whether all pods are started within the specified time in seconds"""
-            pods = self.get_pods(parse=True, quiet=True)
-            try:
-                ages_str = [format_age(pod["AGE"]) for pod in pods]
-                ages_dt = [
-                    dateparser.parse(f"{x} ago", settings={"TIMEZONE": "UTC"}).replace(tzinfo=UTC) for x in ages_str
-                ]
-                dt_now = datetime.now(tz=UTC)
-                seconds_elapsed_from_now = [(dt_now - x).total_seconds() for x in ages_dt]
-            except Exception:
-                logger.error(f"Failed to parse the output of 'kubectl get pods' command: {pods}")
-                raise
-            return all(x <= seconds for x in seconds_elapsed_from_now)
-
-        def wait_for_pod_initialization_to_start() -> bool:
-            pods = self.get_pods(parse=True, quiet=True)
-            return any(pod["STATUS"] in ("PodInitializing", "Init:0/1") for pod in pods)
-
         logger.info(f"Waiting for {self.app_context.app} deployment to start...")
-        if thresholds_to_skip and did_all_pods_start_within(thresholds_to_skip):
+        if thresholds_to_skip and self._did_all_pods_start_within(thresholds_to_skip):
             logger.info(
                 f"SKIPPED: All {self.app_context.app} pods recently started within {thresholds_to_skip} seconds"
             )
         else:
-            try:
-                wait_until(
-                    wait_for_pod_initialization_to_start,
-                    interval=1,
-                    stop_condition=lambda x: x is True,
-                    timeout=timeout_sec,
-                )
-            except TimeoutError:
-                raise TimeoutError(
-                    f"{self.app_context.app} deployment did not start in {timeout_sec} seconds"
-                ) from None
+            # Watch pods instead of polling 'kubectl get pods'. The watch does one LIST followed by streamed changes.
+            # grep reads the watch through a FIFO so that the watch can be stopped as soon as any pod shows up with the
+            # PodInitializing or Init:0/1 status. Otherwise, the exit code of the watch is returned (124 = timed out)
+            cmd = (
+                "fifo=$(mktemp -u) && mkfifo $fifo; "
+                f"timeout {timeout_sec} kubectl get pods {self._app_filtering_options} --watch --no-headers > $fifo & "
+                "pid=$!; "
+                "if grep -q -m1 -E '\\s(PodInitializing|Init:0/1)\\s' < $fifo; then kill $pid; rc=0; "
+                "else wait $pid; rc=$?; [ $rc -eq 0 ] && rc=1; fi; "
+                "rm -f $fifo; exit $rc"
+            )
+            exit_code, output = self.exec_run(cmd, ignore_error=True, quiet=True)
+            if exit_code == 124:
+                raise TimeoutError(f"{self.app_context.app} deployment did not start in {timeout_sec} seconds")
+            elif exit_code:
+                raise RuntimeError(f"Failed to watch {self.app_context.app} pods (exit code: {exit_code}):\n{output}")
             logger.info(f"{self.app_context.app} deployment started")
 
     @requires_container
@@ -489,6 +491,17 @@ class K8sConnector(GCloudSDKContainer):
             raise TimeoutError(f"One or more {self.app_context.app} pods did not become ready:\n{output}")
         logger.info(f"All {self.app_context.app} pods are ready")
 
+    @requires_container
+    def _did_all_pods_start_within(self, seconds: int) -> bool:
+        """Check whether all pods are started within the specified time in seconds"""
+        pods = self.get_pods(parse=True, quiet=True)
+        try:
+            seconds_elapsed_from_now = [parse_age(pod["AGE"]) for pod in pods]
+        except Exception:
+            logger.error(f"Failed to parse the output of 'kubectl get pods' command: {pods}")
+            raise
+        return all(x <= seconds for x in seconds_elapsed_from_now)
+
     @requires_container
     def _setup_kubeconfig(self):
         """Fetch credentials for the cluster and update kubeconfig"""
@@ -500,18 +513,25 @@ class K8sConnector(GCloudSDKContainer):
             cmd += f" --zone {self.zone}"
         self.exec_run(cmd)
 
-    @requires_container
-    def _install_jq(self):
-        """Install jq"""
-        with Lock("k8s_check_jq"):
-            if not K8sConnector.JQ_INSTALLED:
-                self.exec_run("apt-get install -y jq")
-                K8sConnector.JQ_INSTALLED = True
-
     @cached_property
     def _app_filtering_options(self) -> str:
         return f"-l {self.app_label_selector_key}={self.app_context.app} -n {self.app_context.namespace}"
 
+    @cached_property
+    def _get_pods_cmd(self) -> str:
+        if self._app_context:
+            return f"kubectl get pods {self._app_filtering_options}"
+        else:
+            return "kubectl get pods -A"
+
+    @cached_property
+    def _get_events_cmd(self) -> str:
+        cmd = "kubectl get events --sort-by=.metadata.creationTimestamp"
+        if self._app_context:
+            return f"{cmd} -n {self.app_context.namespace}"
+        else:
+            return f"{cmd} -A"
+
 
 class K8sConnectorWithAppContext(K8sConnector):
     """K8s connector with a specific app context"""
@@ -524,13 +544,12 @@ class K8sConnectorWithAppContext(K8sConnector):
             raise NotImplementedError(
                 f"App '{app}' not yet supported. Supported apps: {list(x.value for x in K8sApp._member_map_.values())}"
             )
-        super().__init__(
-            service_account_file_path=k8s_container.service_account_file_path,
-            cluster_name=k8s_container.cluster_name,
-            region=k8s_container.region,
-            zone=k8s_container.zone,
-            run=False,
-            timeout=k8s_container.timeout,
+        # Inherit the state of the given connector, including its container, instead of initializing it again.
+        # Values of cached properties are not inherited as they may depend on the app context
+        self.__dict__.update(
+            (k, v)
+            for k, v in vars(k8s_container).items()
+            if not isinstance(getattr(type(k8s_container), k, None), cached_property)
         )
-        self.container = k8s_container.container
         self._app_context = K8sAppContext(app)
+        self._app_connectors = {}